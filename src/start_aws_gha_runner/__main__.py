@@ -1,6 +1,6 @@
 from start_aws_gha_runner.start import StartAWS
+from start_aws_gha_runner.deploy import StreamingDeployInstance
 from gha_runner.gh import GitHubInstance
-from gha_runner.clouddeployment import DeployInstance
 from gha_runner.helper.input import EnvVarBuilder, check_required
 import os
 
@@ -33,6 +33,8 @@ def main():
             "INPUT_AWS_ROOT_DEVICE_SIZE", "root_device_size", type_hint=int
         )
         .update_state("INPUT_ARCHITECTURE", "arch")
+        .update_state("INPUT_MAX_RUNTIME", "max_runtime", type_hint=int)
+        .update_state("INPUT_LAUNCH_CACHE", "launch_cache")
         # This is the default case
         .update_state("AWS_REGION", "region_name")
         # This is the input case
@@ -53,8 +55,9 @@ def main():
     instance_count = params.pop("instance_count")
 
     gh = GitHubInstance(token=token, repo=repo)
-    # This will create a new instance of StartAWS and configure it correctly
-    deployment = DeployInstance(
+    # This will create a new instance of StartAWS and configure it correctly,
+    # runner tokens are fetched while the instances are being launched
+    deployment = StreamingDeployInstance(
         provider_type=StartAWS,
         cloud_params=params,
         gh=gh,
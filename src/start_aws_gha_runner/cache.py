@@ -0,0 +1,126 @@
+from datetime import datetime, timezone
+from pathlib import Path
+import hashlib
+import json
+
+import boto3
+from botocore.exceptions import ClientError
+from gha_runner.helper.workflow_cmds import warning
+
+# Bump this when the layout of a compiled launch spec changes
+SPEC_VERSION = 1
+
+
+def spec_key(config: dict) -> str:
+    """Hash a launch configuration into a cache key.
+
+    Parameters
+    ----------
+    config : dict
+        The launch configuration, must be JSON serializable.
+
+    Returns
+    -------
+    str
+        The hex digest of the configuration.
+
+    """
+    data = json.dumps(
+        {"version": SPEC_VERSION, "config": config}, sort_keys=True
+    )
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def _split_s3(cache: str, key: str) -> tuple[str, str]:
+    """Split an S3 cache location into a bucket and object key."""
+    bucket, _, prefix = cache.removeprefix("s3://").partition("/")
+    prefix = prefix.strip("/")
+    name = f"{key}.json"
+    return bucket, f"{prefix}/{name}" if prefix else name
+
+
+def _read(cache: str, key: str) -> str | None:
+    """Read a raw cache entry, returning None if it does not exist."""
+    if cache.startswith("s3://"):
+        bucket, object_key = _split_s3(cache, key)
+        s3 = boto3.client("s3")
+        try:
+            out = s3.get_object(Bucket=bucket, Key=object_key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "NoSuchKey":
+                return None
+            raise e
+        return out["Body"].read().decode()
+    path = Path(cache) / f"{key}.json"
+    if not path.exists():
+        return None
+    return path.read_text()
+
+
+def _write(cache: str, key: str, data: str):
+    """Write a raw cache entry."""
+    if cache.startswith("s3://"):
+        bucket, object_key = _split_s3(cache, key)
+        s3 = boto3.client("s3")
+        s3.put_object(Bucket=bucket, Key=object_key, Body=data.encode())
+        return
+    path = Path(cache)
+    path.mkdir(parents=True, exist_ok=True)
+    (path / f"{key}.json").write_text(data)
+
+
+def load_spec(cache: str, key: str, ttl: int) -> dict | None:
+    """Load a compiled launch spec from the cache.
+
+    Parameters
+    ----------
+    cache : str
+        A local directory or an `s3://bucket/prefix` location.
+    key : str
+        The cache key of the launch configuration.
+    ttl : int
+        The maximum age in seconds of a usable spec.
+
+    Returns
+    -------
+    dict | None
+        The compiled launch spec, or None if it is missing or expired.
+
+    """
+    try:
+        data = _read(cache, key)
+        if data is None:
+            return None
+        entry = json.loads(data)
+        created = datetime.fromisoformat(entry["created"])
+        age = datetime.now(timezone.utc) - created
+        if age.total_seconds() > ttl:
+            return None
+        return entry["spec"]
+    except Exception as e:
+        # A broken cache should never stop a launch, we just recompile
+        warning(title="Could not read launch spec cache", message=e)
+        return None
+
+
+def store_spec(cache: str, key: str, spec: dict):
+    """Store a compiled launch spec in the cache.
+
+    Parameters
+    ----------
+    cache : str
+        A local directory or an `s3://bucket/prefix` location.
+    key : str
+        The cache key of the launch configuration.
+    spec : dict
+        The compiled launch spec.
+
+    """
+    entry = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "spec": spec,
+    }
+    try:
+        _write(cache, key, json.dumps(entry))
+    except Exception as e:
+        warning(title="Could not write launch spec cache", message=e)
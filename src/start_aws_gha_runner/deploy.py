@@ -0,0 +1,111 @@
+from dataclasses import dataclass
+import time
+
+from gha_runner.clouddeployment import DeployInstance
+from gha_runner.helper.workflow_cmds import error
+
+from start_aws_gha_runner.start import RunnerBootError
+
+
+@dataclass
+class StreamingDeployInstance(DeployInstance):
+    """Deploy instances while runner tokens are still being fetched.
+
+    Unlike `DeployInstance`, this does not fetch every runner token before
+    the provider is created. Instead the provider is handed the GitHub
+    instance and the number of runners so that it can fetch tokens
+    concurrently and launch each instance as soon as its token arrives.
+    While waiting for the runners to register, the console output of each
+    instance is checked so that a broken runner fails early.
+
+    Parameters
+    ----------
+    provider_type : Type[CreateCloudInstance]
+        The type of cloud provider to use. Must accept the `github` and
+        `runner_count` parameters and provide `check_boot`.
+    cloud_params : dict
+        The parameters to pass to the cloud provider.
+    gh : GitHubInstance
+        The GitHub instance to use.
+    count : int
+        The number of instances to create.
+    timeout : int
+        The timeout to use when waiting for the runner to come online
+    wait : int
+        The time in seconds between checks while waiting for the runners.
+        Defaults to 15 seconds.
+
+    """
+
+    wait: int = 15
+
+    def __post_init__(self):
+        """Initialize the cloud provider without fetching runner tokens."""
+        self.cloud_params["github"] = self.gh
+        self.cloud_params["runner_count"] = self.count
+        architecture = self.cloud_params.get("arch", "x64")
+        release = self.gh.get_latest_runner_release(
+            platform="linux", architecture=architecture
+        )
+        self.cloud_params["runner_release"] = release
+        self.provider = self.provider_type(**self.cloud_params)
+
+    def wait_for_runners(self, mappings: dict[str, str]):
+        """Wait for every runner to register with GitHub.
+
+        Parameters
+        ----------
+        mappings : dict[str, str]
+            A dictionary of instance IDs and labels.
+
+        Raises
+        ------
+        RunnerBootError
+            If an instance fails while booting.
+        RuntimeError
+            If the runners do not register before the timeout.
+
+        """
+        deadline = time.time() + self.timeout
+        pending = dict(mappings)
+        while True:
+            runners = self.gh.get_runners() or []
+            registered = {label for r in runners for label in r.labels}
+            for id, label in list(pending.items()):
+                if label in registered:
+                    print(f"Runner {label} is ready!")
+                    del pending[id]
+            if not pending:
+                return
+            try:
+                self.provider.check_boot(list(pending))
+            except RunnerBootError as e:
+                print(f"Console output of {e.instance_id}:\n{e.tail}")
+                error(title="Runner failed to boot", message=e)
+                raise
+            if time.time() > deadline:
+                labels = list(pending.values())
+                raise RuntimeError(
+                    f"Timeout reached: Runners {labels} not found"
+                )
+            print(f"Waiting for {list(pending.values())}...")
+            time.sleep(self.wait)
+
+    def start_runner_instances(self):
+        """Start the runner instances.
+
+        This function starts the runner instances and waits for them to be
+        ready, failing early if an instance fails to boot.
+
+        """
+        print("Starting up...")
+        print("Creating GitHub Actions Runner")
+        mappings = self.provider.create_instances()
+        instance_ids = list(mappings.keys())
+        # Output the instance mapping and labels so the stop action can use them
+        self.provider.set_instance_mapping(mappings)
+        print("Waiting for instance to be ready...")
+        self.provider.wait_until_ready(instance_ids)
+        print("Instance is ready!")
+        # Confirm the runners are registered with GitHub
+        self.wait_for_runners(mappings)
@@ -0,0 +1,246 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+import json
+import os
+
+import boto3
+from gha_runner.gh import GitHubInstance
+from gha_runner.helper.input import EnvVarBuilder, check_required
+from gha_runner.helper.workflow_cmds import output, warning
+
+from start_aws_gha_runner.start import (
+    EXPIRY_TAG,
+    LABEL_TAG,
+    REPO_TAG,
+    RUN_ID_TAG,
+)
+
+# The maximum number of instance IDs accepted by a single TerminateInstances
+TERMINATE_BATCH_SIZE = 1000
+
+
+@dataclass
+class ReapAWS:
+    """Class to terminate orphaned GitHub Actions runners on AWS.
+
+    An instance is considered orphaned when it has passed its expiry tag,
+    when the workflow run that started it has completed, or when it has been
+    running longer than the grace period without a runner with its label
+    registered on GitHub.
+
+    Parameters
+    ----------
+    repo : str
+        The repository the runners were started for.
+    regions : list[str]
+        The AWS regions to search for runner instances.
+    github : GitHubInstance
+        The GitHub instance used to look up registered runners.
+    grace_period : int
+        The number of seconds an instance may run before its runner must be
+        registered. Defaults to 1200.
+
+    """
+
+    repo: str
+    regions: list[str]
+    github: GitHubInstance
+    grace_period: int = 1200
+
+    def _find_instances(self, client) -> list[dict]:
+        """Find the live runner instances for this repo in a region.
+
+        Parameters
+        ----------
+        client
+            The EC2 client object.
+
+        Returns
+        -------
+        list[dict]
+            The instances tagged with this repo that have not terminated.
+
+        """
+        paginator = client.get_paginator("describe_instances")
+        pages = paginator.paginate(
+            Filters=[
+                {"Name": f"tag:{REPO_TAG}", "Values": [self.repo]},
+                {
+                    "Name": "instance-state-name",
+                    "Values": ["pending", "running", "stopping", "stopped"],
+                },
+            ],
+        )
+        instances = []
+        for page in pages:
+            for reservation in page["Reservations"]:
+                instances.extend(reservation["Instances"])
+        return instances
+
+    def _completed_runs(self, run_ids: set[str]) -> set[str]:
+        """Find the workflow runs that have completed.
+
+        Parameters
+        ----------
+        run_ids : set[str]
+            The IDs of the workflow runs to look up.
+
+        Returns
+        -------
+        set[str]
+            The IDs of the runs whose status is completed.
+
+        """
+        completed = set()
+        for run_id in run_ids:
+            try:
+                run = self.github.get(
+                    f"repos/{self.repo}/actions/runs/{run_id}"
+                )
+            except RuntimeError as e:
+                # We fall back on the other checks for this run
+                warning(title=f"Could not get workflow run {run_id}", message=e)
+                continue
+            if run["status"] == "completed":
+                completed.add(run_id)
+        return completed
+
+    def _find_stale(
+        self,
+        instances: list[dict],
+        labels: set[str],
+        completed: set[str],
+        now: datetime,
+    ) -> list[str]:
+        """Select the instances that should be terminated.
+
+        Parameters
+        ----------
+        instances : list[dict]
+            The instances as returned by `describe_instances`.
+        labels : set[str]
+            The labels of every runner registered on GitHub.
+        completed : set[str]
+            The IDs of the workflow runs that have completed.
+        now : datetime
+            The current time.
+
+        Returns
+        -------
+        list[str]
+            The IDs of the stale instances.
+
+        """
+        grace = timedelta(seconds=self.grace_period)
+        stale = []
+        for instance in instances:
+            id = instance["InstanceId"]
+            tags = {t["Key"]: t["Value"] for t in instance.get("Tags", [])}
+            expiry = tags.get(EXPIRY_TAG)
+            try:
+                expired = (
+                    expiry is not None and datetime.fromisoformat(expiry) <= now
+                )
+            except (TypeError, ValueError) as e:
+                warning(title=f"Skipping instance {id}", message=e)
+                continue
+            if expired or tags.get(RUN_ID_TAG) in completed:
+                stale.append(id)
+            elif (
+                tags.get(LABEL_TAG) not in labels
+                and instance["LaunchTime"] + grace <= now
+            ):
+                stale.append(id)
+        return stale
+
+    def _terminate(self, client, ids: list[str]):
+        """Terminate instances in batches.
+
+        Parameters
+        ----------
+        client
+            The EC2 client object.
+        ids : list[str]
+            The IDs of the instances to terminate.
+
+        """
+        for start in range(0, len(ids), TERMINATE_BATCH_SIZE):
+            batch = ids[start : start + TERMINATE_BATCH_SIZE]
+            client.terminate_instances(InstanceIds=batch)
+
+    def reap(self) -> dict[str, list[str]]:
+        """Terminate orphaned runner instances in every region.
+
+        Returns
+        -------
+        dict[str, list[str]]
+            A dictionary of regions and the instance IDs terminated in them.
+
+        """
+        runners = self.github.get_runners() or []
+        labels = {label for runner in runners for label in runner.labels}
+        found = {}
+        for region in self.regions:
+            ec2 = boto3.client("ec2", region_name=region)
+            found[region] = (ec2, self._find_instances(ec2))
+        run_ids = {
+            tag["Value"]
+            for _, instances in found.values()
+            for instance in instances
+            for tag in instance.get("Tags", [])
+            if tag["Key"] == RUN_ID_TAG and tag["Value"]
+        }
+        completed = self._completed_runs(run_ids)
+        now = datetime.now(timezone.utc)
+        reaped = {}
+        for region, (ec2, instances) in found.items():
+            stale = self._find_stale(instances, labels, completed, now)
+            if stale:
+                self._terminate(ec2, stale)
+            reaped[region] = stale
+        return reaped
+
+
+def main():
+    env = dict(os.environ)
+    required = ["GH_PAT", "AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"]
+    # Check that everything exists
+    check_required(env, required)
+    params = (
+        EnvVarBuilder(env)
+        # This is the default case
+        .update_state("AWS_REGION", "region_name")
+        # This is the input case
+        .update_state("INPUT_AWS_REGION_NAME", "region_name")
+        .update_state("INPUT_REAPER_REGIONS", "regions")
+        .update_state("INPUT_GH_TIMEOUT", "grace_period", type_hint=int)
+        # This is the default case
+        .update_state("GITHUB_REPOSITORY", "repo")
+        # This is the input case
+        .update_state("INPUT_GH_REPO", "repo")
+    ).params
+    repo = params.get("repo")
+    if repo is None:
+        raise Exception("Repo cannot be empty")
+    regions = params.pop("regions", None)
+    region_name = params.pop("region_name", None)
+    if regions is not None:
+        regions = [region.strip() for region in regions.split(",")]
+        params["regions"] = [region for region in regions if region]
+    elif region_name is not None:
+        params["regions"] = [region_name]
+    else:
+        raise Exception("Region cannot be empty")
+
+    gh = GitHubInstance(token=env["GH_PAT"], repo=repo)
+    reaper = ReapAWS(github=gh, **params)
+    reaped = reaper.reap()
+    for region, ids in reaped.items():
+        print(f"Terminated {len(ids)} instances in {region}")
+    # The reaper can also be run outside of a workflow
+    if "GITHUB_OUTPUT" in env:
+        output("reaped", json.dumps(reaped))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,116 @@
 import importlib.resources
+from collections.abc import Iterable, Iterator
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass, field
+from typing import Any
+from datetime import datetime, timedelta, timezone
 from string import Template
 import json
+import os
 
 import boto3
 from botocore.exceptions import ClientError
 from gha_runner import gh
 from gha_runner.clouddeployment import CreateCloudInstance
-from gha_runner.helper.workflow_cmds import output
+from gha_runner.helper.workflow_cmds import error, output, warning
 from copy import deepcopy
 
+from start_aws_gha_runner.cache import load_spec, spec_key, store_spec
+
+# Tag keys applied to every runner instance, used by the reaper to find them
+RUN_ID_TAG = "gha-runner:run-id"
+REPO_TAG = "gha-runner:repo"
+LABEL_TAG = "gha-runner:label"
+EXPIRY_TAG = "gha-runner:expiry"
+
+# The only values a compiled launch spec may hold, everything else is built
+# from the current configuration on every run
+LAUNCH_SPEC_KEYS = {"ImageId", "BlockDeviceMappings"}
+AMI_ID_PATTERN = re.compile(r"ami-[0-9a-f]+")
+
+# Errors from RunInstances meaning the AMI in a cached launch spec is gone
+STALE_AMI_ERRORS = ("InvalidAMIID.NotFound", "InvalidAMIID.Unavailable")
+
+# Lines in the console output that mean the runner will never register
+BOOT_FAILURE_PATTERNS = [
+    re.compile(r"curl: \(\d+\)"),
+    re.compile(r"Http response code: \w+"),
+    re.compile(r"An error occurred: "),
+    re.compile(r"Failed running /var/lib/cloud/instance/scripts"),
+]
+# The number of console output lines to include when a boot fails
+BOOT_LOG_TAIL = 20
+# Errors from GetConsoleOutput meaning we are not allowed to read it at all
+CONSOLE_DENIED_ERRORS = ("AccessDenied", "UnauthorizedOperation")
+# The number of characters remembered to find our place in the console output
+CONSOLE_ANCHOR_SIZE = 1024
+
+
+class RunnerBootError(Exception):
+    """Exception raised when a runner instance fails while booting.
+
+    Parameters
+    ----------
+    instance_id : str
+        The ID of the instance that failed.
+    tail : str
+        The last lines of the instance console output.
+
+    """
+
+    def __init__(self, instance_id: str, tail: str):
+        self.instance_id = instance_id
+        self.tail = tail
+        super().__init__(f"Instance {instance_id} failed to boot")
+
+
+# On-demand vCPU quota codes for the instance families that have their own
+# quota, checked from the longest prefix down
+FAMILY_QUOTA_CODES = {
+    "trn": "L-2C3B7624",
+    "inf": "L-1945791B",
+    "hpc": "L-F7808C92",
+    "dl": "L-6E869C2A",
+    "vt": "L-DB2E81BA",
+    "g": "L-DB2E81BA",
+    "p": "L-417A185B",
+    "f": "L-74FC7D96",
+    "x": "L-7295265B",
+}
+# The standard (A, C, D, H, I, M, R, T, Z) on-demand vCPU quota code
+STANDARD_QUOTA_CODE = "L-1216C47A"
+STANDARD_FAMILIES = "acdhimrtz"
+
+
+def quota_code(instance_type: str) -> str | None:
+    """Find the on-demand vCPU quota code for an instance type.
+
+    Parameters
+    ----------
+    instance_type : str
+        The type of instance, for example `t2.micro`.
+
+    Returns
+    -------
+    str | None
+        The quota code, or None if the type is not covered by a vCPU quota.
+
+    """
+    match = re.match(r"[a-z]+", instance_type)
+    if match is None:
+        return None
+    prefix = match.group()
+    # Mac instances run on dedicated hosts and have no vCPU quota
+    if prefix == "mac":
+        return None
+    for family, code in FAMILY_QUOTA_CODES.items():
+        if prefix.startswith(family):
+            return code
+    if prefix[0] in STANDARD_FAMILIES:
+        return STANDARD_QUOTA_CODE
+    return None
+
 
 @dataclass
 class StartAWS(CreateCloudInstance):
@@ -31,6 +132,27 @@ class StartAWS(CreateCloudInstance):
         A list of tags to apply to the instance. Defaults to an empty list.
     gh_runner_tokens : list[str]
         A list of GitHub runner tokens. Defaults to an empty list.
+    github : gh.GitHubInstance | None
+        The GitHub instance used to fetch runner tokens on demand when
+        `gh_runner_tokens` is empty. Defaults to None.
+    runner_count : int
+        The number of runner tokens to fetch from `github`. Defaults to 0.
+    max_workers : int
+        The maximum number of concurrent token fetches and EC2 launches.
+        Defaults to 10.
+    max_runtime : int
+        The number of seconds after launch that the instance is considered
+        expired by the reaper. Defaults to 86400 (24 hours).
+    preflight : bool
+        Whether to check the vCPU quota before launching any instances.
+        Defaults to True.
+    launch_cache : str
+        A local directory or `s3://bucket/prefix` location used to cache
+        compiled launch specs. Defaults to an empty string which disables
+        the cache.
+    launch_cache_ttl : int
+        The maximum age in seconds of a cached launch spec. Defaults to
+        86400 (24 hours).
     root_device_size : int
         The size of the root device. Defaults to 0 which uses the default.
     labels : str
@@ -55,12 +177,27 @@ class StartAWS(CreateCloudInstance):
     image_name: str = ""
     tags: list[dict[str, str]] = field(default_factory=list)
     gh_runner_tokens: list[str] = field(default_factory=list)
+    github: gh.GitHubInstance | None = None
+    runner_count: int = 0
+    max_workers: int = 10
+    max_runtime: int = 86400
+    preflight: bool = True
+    launch_cache: str = ""
+    launch_cache_ttl: int = 86400
     root_device_size: int = 0
     labels: str = ""
     subnet_id: str = ""
     security_group_id: str = ""
     iam_role: str = ""
     script: str = ""
+    _console_anchors: dict[str, str] = field(
+        default_factory=dict, init=False, repr=False
+    )
+    _console_client: Any = field(default=None, init=False, repr=False)
+    _console_warned: set[str] = field(
+        default_factory=set, init=False, repr=False
+    )
+    _console_denied: bool = field(default=False, init=False, repr=False)
 
     def _build_aws_params(self, user_data_params: dict) -> dict:
         """Build the parameters for the AWS API call.
@@ -95,6 +232,30 @@ class StartAWS(CreateCloudInstance):
 
         return params
 
+    def _build_runner_tags(self, label: str) -> list[dict[str, str]]:
+        """Build the tags that identify a runner instance.
+
+        Parameters
+        ----------
+        label : str
+            The GitHub runner label of the instance.
+
+        Returns
+        -------
+        list[dict[str, str]]
+            A list of tags with the run ID, repo, label, and expiry.
+
+        """
+        expiry = datetime.now(timezone.utc) + timedelta(
+            seconds=self.max_runtime
+        )
+        return [
+            {"Key": RUN_ID_TAG, "Value": os.environ.get("GITHUB_RUN_ID", "")},
+            {"Key": REPO_TAG, "Value": self.repo},
+            {"Key": LABEL_TAG, "Value": label},
+            {"Key": EXPIRY_TAG, "Value": expiry.isoformat(timespec="seconds")},
+        ]
+
     def _build_user_data(self, **kwargs) -> str:
         """Build the user data script.
 
@@ -182,17 +343,315 @@ class StartAWS(CreateCloudInstance):
                 raise e
         return params
 
+    def _vcpus_by_type(self, client, types: set[str]) -> dict[str, int]:
+        """Look up the default number of vCPUs for instance types.
+
+        Parameters
+        ----------
+        client
+            The EC2 client object.
+        types : set[str]
+            The instance types to look up.
+
+        Returns
+        -------
+        dict[str, int]
+            A dictionary of instance types and their vCPU counts.
+
+        """
+        paginator = client.get_paginator("describe_instance_types")
+        vcpus = {}
+        for page in paginator.paginate(InstanceTypes=sorted(types)):
+            for info in page["InstanceTypes"]:
+                vcpus[info["InstanceType"]] = info["VCpuInfo"]["DefaultVCpus"]
+        return vcpus
+
+    def _check_capacity(self, client, quotas, count: int):
+        """Check that the vCPU quota can fit every requested instance.
+
+        Parameters
+        ----------
+        client
+            The EC2 client object.
+        quotas
+            The Service Quotas client object.
+        count : int
+            The number of instances that will be launched.
+
+        Raises
+        ------
+        RuntimeError
+            If launching `count` instances would exceed the vCPU quota.
+
+        """
+        code = quota_code(self.instance_type)
+        if code is None:
+            return
+        try:
+            out = quotas.get_service_quota(ServiceCode="ec2", QuotaCode=code)
+            limit = out["Quota"]["Value"]
+            paginator = client.get_paginator("describe_instances")
+            pages = paginator.paginate(
+                Filters=[
+                    {
+                        "Name": "instance-state-name",
+                        "Values": ["pending", "running"],
+                    }
+                ]
+            )
+            running = [
+                instance["InstanceType"]
+                for page in pages
+                for reservation in page["Reservations"]
+                for instance in reservation["Instances"]
+                # Spot and capacity block instances count against other
+                # quotas, only on-demand instances leave this field unset
+                if "InstanceLifecycle" not in instance
+                and quota_code(instance["InstanceType"]) == code
+            ]
+            vcpus = self._vcpus_by_type(
+                client, set(running) | {self.instance_type}
+            )
+        except ClientError as e:
+            # Not being able to read the quota or usage should not block the
+            # launch, AWS will still enforce the quota when we run instances
+            warning(title="Skipping vCPU quota check", message=e)
+            return
+        used = sum(vcpus[t] for t in running)
+        needed = vcpus[self.instance_type] * count
+        if used + needed > limit:
+            raise RuntimeError(
+                f"Launching {count} {self.instance_type} instances needs "
+                f"{needed} vCPUs but only {limit - used:g} of the {limit:g} "
+                f"vCPU quota ({code}) are available."
+            )
+
+    def _stream_runner_tokens(self) -> Iterator[str]:
+        """Yield GitHub runner tokens as they become available.
+
+        If tokens were provided up front they are yielded directly, otherwise
+        they are fetched concurrently from GitHub and yielded in the order
+        they arrive.
+
+        Yields
+        ------
+        str
+            A GitHub runner registration token.
+
+        """
+        if self.gh_runner_tokens:
+            yield from self.gh_runner_tokens
+            return
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            pending = [
+                pool.submit(self.github.create_runner_token)
+                for _ in range(self.runner_count)
+            ]
+            for future in as_completed(pending):
+                yield future.result()
+
+    def _launch_spec_config(self) -> dict:
+        """Collect the configuration that a compiled launch spec depends on.
+
+        Returns
+        -------
+        dict
+            The configuration used to build the cache key.
+
+        """
+        return {
+            "image_id": self.image_id,
+            "image_name": self.image_name,
+            "region_name": self.region_name,
+            "root_device_size": self.root_device_size,
+        }
+
+    def _compile_launch_spec(self, client) -> dict:
+        """Compile the parameters that need describe calls to resolve.
+
+        The resulting spec only holds the resolved AMI and, if the root
+        device is resized, the block devices.
+
+        Parameters
+        ----------
+        client
+            The EC2 client object.
+
+        Returns
+        -------
+        dict
+            The resolved parameters for the AWS API call.
+
+        """
+        # We need to handle the case where someone wants to always use latest
+        if self.image_id == "latest":
+            if not self.image_name:
+                raise ValueError(
+                    "Looking for latest image but name not provided"
+                )
+            # This updates the image ID to the latest, will fail if image does not exist
+            self.image_id = self._fetch_latest_ami(client, self.image_name)
+        spec = {"ImageId": self.image_id}
+        if self.root_device_size > 0:
+            spec = self._modify_root_disk_size(client, spec)
+        return spec
+
+    def _load_launch_spec(
+        self, client, config: dict, refresh: bool = False
+    ) -> tuple[dict, bool]:
+        """Load the compiled launch spec, compiling it on a cache miss.
+
+        Parameters
+        ----------
+        client
+            The EC2 client object.
+        config : dict
+            The launch configuration the spec is compiled from.
+        refresh : bool
+            Whether to ignore and overwrite a cached spec. Defaults to False.
+
+        Returns
+        -------
+        tuple[dict, bool]
+            The resolved parameters for the AWS API call and whether they
+            came from the cache.
+
+        """
+        if not self.launch_cache:
+            return self._compile_launch_spec(client), False
+        key = spec_key(config)
+        if not refresh:
+            spec = load_spec(self.launch_cache, key, self.launch_cache_ttl)
+            # The cache is only trusted for the values it is meant to hold
+            if spec is not None and not (
+                set(spec) <= LAUNCH_SPEC_KEYS
+                and isinstance(spec.get("ImageId"), str)
+                and AMI_ID_PATTERN.fullmatch(spec["ImageId"])
+                and isinstance(spec.get("BlockDeviceMappings", []), list)
+            ):
+                warning(
+                    title="Ignoring invalid cached launch spec", message=key
+                )
+                spec = None
+            if spec is not None:
+                print(f"Using cached launch spec {key}")
+                self.image_id = spec["ImageId"]
+                return spec, True
+        # Resolve from the requested image, not a previously cached AMI
+        self.image_id = config["image_id"]
+        spec = self._compile_launch_spec(client)
+        store_spec(self.launch_cache, key, spec)
+        return spec, False
+
+    def _launch_all(
+        self, client, tokens: Iterable[str], spec: dict
+    ) -> tuple[dict[str, str], list[tuple[str | None, Exception]]]:
+        """Launch an instance for every token as the tokens arrive.
+
+        Parameters
+        ----------
+        client
+            The EC2 client object.
+        tokens : Iterable[str]
+            The GitHub runner tokens to launch instances for.
+        spec : dict
+            The compiled launch spec shared by every instance.
+
+        Returns
+        -------
+        tuple[dict[str, str], list[tuple[str | None, Exception]]]
+            A dictionary of the launched instance IDs and labels, and the
+            tokens that failed with their errors. An error from `tokens`
+            itself is reported with a token of None.
+
+        """
+        id_dict = {}
+        failed = []
+        launches = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as launcher:
+            try:
+                for token in tokens:
+                    launch = launcher.submit(
+                        self._launch_instance, client, token, spec
+                    )
+                    launches.append((token, launch))
+            except Exception as e:
+                failed.append((None, e))
+        for token, launch in launches:
+            try:
+                id, label = launch.result()
+                id_dict[id] = label
+            except Exception as e:
+                failed.append((token, e))
+        return id_dict, failed
+
+    def _launch_instance(
+        self, client, token: str, spec: dict
+    ) -> tuple[str, str]:
+        """Launch a single runner instance.
+
+        Parameters
+        ----------
+        client
+            The EC2 client object.
+        token : str
+            The GitHub runner token for this instance.
+        spec : dict
+            The compiled launch spec shared by every instance.
+
+        Returns
+        -------
+        tuple[str, str]
+            The instance ID and its GitHub runner label.
+
+        """
+        label = gh.GitHubInstance.generate_random_label()
+        labels = self.labels
+        if labels == "":
+            labels = label
+        else:
+            labels = self.labels + "," + label
+        user_data_params = {
+            "token": token,
+            "repo": self.repo,
+            "homedir": self.home_dir,
+            "script": self.script,
+            "runner_release": self.runner_release,
+            "labels": labels,
+        }
+        # Everything but the resolved spec is built from the current config
+        params = self._build_aws_params(user_data_params)
+        params.update(deepcopy(spec))
+        specs = {
+            "ResourceType": "instance",
+            "Tags": self.tags + self._build_runner_tags(label),
+        }
+        params["TagSpecifications"] = [specs]
+        result = client.run_instances(**params)
+        instances = result["Instances"]
+        return instances[0]["InstanceId"], label
+
     def create_instances(self) -> dict[str, str]:
         """Create instances on AWS.
 
         Creates and registers instances on AWS using the provided parameters.
+        Runner tokens are consumed as they are produced, so each instance is
+        launched as soon as its token is available. If any launch fails, the
+        instances that did start are terminated before the error is raised.
 
         Returns
         -------
         dict[str, str]
             A dictionary of instance IDs and labels.
+
+        Raises
+        ------
+        RuntimeError
+            If the pre-flight check finds the vCPU quota is too small.
         """
-        if not self.gh_runner_tokens:
+        if not self.gh_runner_tokens and (
+            self.github is None or self.runner_count < 1
+        ):
             raise ValueError(
                 "No GitHub runner tokens provided, cannot create instances."
             )
@@ -215,39 +674,126 @@ class StartAWS(CreateCloudInstance):
                 "No region name provided, cannot create instances."
             )
         ec2 = boto3.client("ec2", region_name=self.region_name)
-        id_dict = {}
-        for token in self.gh_runner_tokens:
-            label = gh.GitHubInstance.generate_random_label()
-            labels = self.labels
-            if labels == "":
-                labels = label
-            else:
-                labels = self.labels + "," + label
-            user_data_params = {
-                "token": token,
-                "repo": self.repo,
-                "homedir": self.home_dir,
-                "script": self.script,
-                "runner_release": self.runner_release,
-                "labels": labels,
-            }
-            # We need to handle the case where someone wants to always use latest
-            if self.image_id == "latest":
-                if not self.image_name:
-                    raise ValueError(
-                        "Looking for latest image but name not provided"
+        # The AMI and block devices are the same for every instance, so we
+        # only resolve them once
+        config = self._launch_spec_config()
+        spec, cached = self._load_launch_spec(ec2, config)
+        if self.preflight:
+            quotas = boto3.client(
+                "service-quotas", region_name=self.region_name
+            )
+            count = len(self.gh_runner_tokens) or self.runner_count
+            self._check_capacity(ec2, quotas, count)
+        id_dict, failed = self._launch_all(
+            ec2, self._stream_runner_tokens(), spec
+        )
+        # A cached spec can point at an AMI that has since been deregistered,
+        # in that case we recompile it and retry the failed launches once
+        stale = [
+            token
+            for token, e in failed
+            if isinstance(e, ClientError)
+            and e.response["Error"]["Code"] in STALE_AMI_ERRORS
+        ]
+        if cached and failed and len(stale) == len(failed):
+            print("Cached launch spec is out of date, recompiling...")
+            spec, _ = self._load_launch_spec(ec2, config, refresh=True)
+            retried, failed = self._launch_all(ec2, stale, spec)
+            id_dict.update(retried)
+        # A partial launch is rolled back so that we either get every runner
+        # or are not left paying for any of them
+        if failed:
+            if id_dict:
+                try:
+                    ec2.terminate_instances(InstanceIds=list(id_dict))
+                except Exception as e:
+                    error(
+                        title="Failed to remove instances, check your "
+                        "provider console",
+                        message=f"Instances {list(id_dict)} are still "
+                        f"running: {e}",
                     )
-                # This updates the image ID to the latest, will fail if image does not exist
-                self.image_id = self._fetch_latest_ami(ec2, self.image_name)
-            params = self._build_aws_params(user_data_params)
-            if self.root_device_size > 0:
-                params = self._modify_root_disk_size(ec2, params)
-            result = ec2.run_instances(**params)
-            instances = result["Instances"]
-            id = instances[0]["InstanceId"]
-            id_dict[id] = label
+            raise failed[0][1]
         return id_dict
 
+    def _read_console_output(self, client, id: str) -> tuple[str, str]:
+        """Read the console output of an instance that has not been seen.
+
+        Only complete lines are returned, a trailing partial line is read
+        again on the next call.
+
+        Parameters
+        ----------
+        client
+            The EC2 client object.
+        id : str
+            The ID of the instance.
+
+        Returns
+        -------
+        tuple[str, str]
+            The new console output and the full console output.
+
+        """
+        console = client.get_console_output(InstanceId=id).get("Output", "")
+        # The console output is a rolling window, so we find where we left
+        # off by the content we last read rather than by position. If it has
+        # rolled past that point we read the whole window again. We take the
+        # first match since a repeated block would otherwise skip ahead of
+        # lines we have not read, while rereading clean lines is harmless.
+        anchor = self._console_anchors.get(id, "")
+        start = 0
+        if anchor:
+            found = console.find(anchor)
+            if found != -1:
+                start = found + len(anchor)
+        end = console.rfind("\n", start) + 1
+        if end == 0:
+            return "", console
+        self._console_anchors[id] = console[
+            max(0, end - CONSOLE_ANCHOR_SIZE) : end
+        ]
+        return console[start:end], console
+
+    def check_boot(self, ids: list[str]):
+        """Check the console output of instances for boot failures.
+
+        Parameters
+        ----------
+        ids : list[str]
+            A list of instance IDs to check.
+
+        Raises
+        ------
+        RunnerBootError
+            If the user data of an instance failed.
+
+        """
+        # Without permission to read the console there is nothing to check
+        if self._console_denied:
+            return
+        if self._console_client is None:
+            self._console_client = boto3.client("ec2", self.region_name)
+        for id in ids:
+            try:
+                new, console = self._read_console_output(
+                    self._console_client, id
+                )
+            except ClientError as e:
+                # The console output is only used for diagnostics, the wait
+                # for the runner carries on without it
+                if e.response["Error"]["Code"] in CONSOLE_DENIED_ERRORS:
+                    warning(title="Skipping boot checks", message=e)
+                    self._console_denied = True
+                    return
+                if id not in self._console_warned:
+                    warning(title=f"Skipping boot check for {id}", message=e)
+                    self._console_warned.add(id)
+                continue
+            if any(pattern.search(new) for pattern in BOOT_FAILURE_PATTERNS):
+                tail = "\n".join(console.splitlines()[-BOOT_LOG_TAIL:])
+                raise RunnerBootError(id, tail)
+
     def wait_until_ready(self, ids: list[str], **kwargs):
         """Wait until instances are running.
 
@@ -0,0 +1,63 @@
+import json
+import boto3
+import pytest
+from datetime import datetime, timedelta, timezone
+from moto import mock_aws
+from start_aws_gha_runner.cache import load_spec, spec_key, store_spec
+
+
+def test_spec_key_is_stable():
+    assert spec_key({"a": 1, "b": 2}) == spec_key({"b": 2, "a": 1})
+    assert spec_key({"a": 1}) != spec_key({"a": 2})
+
+
+def test_disk_cache(tmp_path):
+    cache = str(tmp_path / "specs")
+    assert load_spec(cache, "key", 60) is None
+    store_spec(cache, "key", {"ImageId": "ami-12345678"})
+    assert load_spec(cache, "key", 60) == {"ImageId": "ami-12345678"}
+
+
+def test_disk_cache_expired(tmp_path):
+    created = datetime.now(timezone.utc) - timedelta(hours=2)
+    entry = {"created": created.isoformat(), "spec": {}}
+    (tmp_path / "key.json").write_text(json.dumps(entry))
+    assert load_spec(str(tmp_path), "key", 3600) is None
+
+
+def test_disk_cache_corrupt(tmp_path, capsys):
+    (tmp_path / "key.json").write_text("not json")
+    assert load_spec(str(tmp_path), "key", 60) is None
+    assert "Could not read launch spec cache" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize(
+    "entry",
+    [
+        # No spec in the entry
+        {"created": datetime.now(timezone.utc).isoformat()},
+        # A timestamp without a timezone cannot be compared with ours
+        {"created": datetime.now().isoformat(), "spec": {}},
+    ],
+)
+def test_disk_cache_malformed_entry(tmp_path, capsys, entry):
+    (tmp_path / "key.json").write_text(json.dumps(entry))
+    assert load_spec(str(tmp_path), "key", 60) is None
+    assert "Could not read launch spec cache" in capsys.readouterr().out
+
+
+@pytest.fixture(scope="function")
+def bucket():
+    with mock_aws():
+        s3 = boto3.client("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket="specs")
+        yield s3
+
+
+def test_s3_cache(bucket):
+    cache = "s3://specs/launch"
+    assert load_spec(cache, "key", 60) is None
+    store_spec(cache, "key", {"ImageId": "ami-12345678"})
+    assert load_spec(cache, "key", 60) == {"ImageId": "ami-12345678"}
+    out = bucket.list_objects_v2(Bucket="specs")
+    assert [o["Key"] for o in out["Contents"]] == ["launch/key.json"]
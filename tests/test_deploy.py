@@ -0,0 +1,86 @@
+import pytest
+import responses
+from unittest.mock import Mock, call
+from gha_runner.gh import GitHubInstance, SelfHostedRunner
+from start_aws_gha_runner.deploy import StreamingDeployInstance
+from start_aws_gha_runner.start import RunnerBootError
+
+
+@responses.activate
+def test_streaming_deploy_does_not_prefetch_tokens():
+    responses.add(
+        responses.GET,
+        "https://api.github.com/repos/actions/runner/releases/latest",
+        json={
+            "assets": [
+                {
+                    "name": "actions-runner-linux-x64-2.0.0.tar.gz",
+                    "browser_download_url": "https://example.com/x64.tar.gz",
+                }
+            ]
+        },
+    )
+    gh = GitHubInstance(token="testing", repo="omsf-eco-infra/awsinfratesting")
+    provider_type = Mock()
+    deployment = StreamingDeployInstance(
+        provider_type=provider_type,
+        cloud_params={},
+        gh=gh,
+        count=3,
+        timeout=10,
+    )
+    # Only the release lookup should hit GitHub, tokens are left to the provider
+    assert len(responses.calls) == 1
+    provider_type.assert_called_once_with(
+        github=gh,
+        runner_count=3,
+        runner_release="https://example.com/x64.tar.gz",
+    )
+    assert deployment.provider is provider_type.return_value
+
+
+def _deployment(provider):
+    deployment = StreamingDeployInstance.__new__(StreamingDeployInstance)
+    deployment.gh = Mock()
+    deployment.provider = provider
+    deployment.timeout = 1200
+    deployment.wait = 0
+    return deployment
+
+
+def test_wait_for_runners():
+    provider = Mock()
+    deployment = _deployment(provider)
+    deployment.gh.get_runners.side_effect = [
+        None,
+        [SelfHostedRunner(1, "a", "linux", ["runner-a"])],
+        [
+            SelfHostedRunner(1, "a", "linux", ["runner-a"]),
+            SelfHostedRunner(2, "b", "linux", ["runner-b"]),
+        ],
+    ]
+    deployment.wait_for_runners({"i-a": "runner-a", "i-b": "runner-b"})
+    assert provider.check_boot.call_args_list == [
+        call(["i-a", "i-b"]),
+        call(["i-b"]),
+    ]
+
+
+def test_wait_for_runners_boot_failure(capsys):
+    provider = Mock()
+    provider.check_boot.side_effect = RunnerBootError("i-a", "curl: (6) failed")
+    deployment = _deployment(provider)
+    deployment.gh.get_runners.return_value = None
+    with pytest.raises(RunnerBootError):
+        deployment.wait_for_runners({"i-a": "runner-a"})
+    out = capsys.readouterr().out
+    assert "curl: (6) failed" in out
+    assert "::error title=Runner failed to boot::" in out
+
+
+def test_wait_for_runners_timeout():
+    deployment = _deployment(Mock())
+    deployment.timeout = -1
+    deployment.gh.get_runners.return_value = None
+    with pytest.raises(RuntimeError, match="Timeout reached"):
+        deployment.wait_for_runners({"i-a": "runner-a"})
